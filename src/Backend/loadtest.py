@@ -0,0 +1,542 @@
+"""Local load-testing harness for the conversion server.
+
+Starts ``server_enhanced`` on a free local port, replays a weighted mix of
+generated PDFs against ``/convert`` (and ``/health``) and reports throughput,
+latency percentiles, error rates and the server's peak RSS. Everything runs
+offline; ``--stub-ocr`` replaces Tesseract with a fixed-latency stub.
+
+Examples:
+    python loadtest.py --concurrency 20 --requests 200 --stub-ocr
+    python loadtest.py --rate 5 --duration 60 --mix small=5,large=1,health=2
+    python loadtest.py --stub-ocr --save-baseline baseline.json
+    python loadtest.py --stub-ocr --baseline baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional, List, Dict, Any, Tuple
+
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Generated document shapes, keyed by the names used in --mix
+PDF_PROFILES = {
+    'small': {'pages': 1, 'images_per_page': 0},
+    'medium': {'pages': 5, 'images_per_page': 1},
+    'large': {'pages': 20, 'images_per_page': 2},
+}
+DEFAULT_MIX = 'small=5,medium=3,large=1,health=1'
+SERVER_START_TIMEOUT = 30
+RSS_POLL_INTERVAL = 0.2
+
+# Ignore HTTP_PROXY & co: traffic must stay local and never leave the machine
+HTTP_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat."
+).split()
+
+
+# --- Workload generation ---------------------------------------------------
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse a 'name=weight,...' mix into a weight per request kind."""
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in PDF_PROFILES and name != 'health':
+            raise ValueError(f"Unknown request kind '{name}'. Allowed: {', '.join([*PDF_PROFILES, 'health'])}")
+        weights[name] = float(weight) if weight else 1.0
+    if not any(weights.values()):
+        raise ValueError("Request mix has no positive weight")
+    return weights
+
+
+def generate_image(rng: random.Random, width: int = 480, height: int = 240) -> bytes:
+    """Generate a PNG image containing a line of text for OCR."""
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x0, y0, x0 + rng.randrange(20, 120), y0 + rng.randrange(10, 60)], fill=color)
+    draw.text((20, height // 2), " ".join(rng.choices(LOREM, k=6)), fill=(0, 0, 0))
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def generate_pdf(pages: int, images_per_page: int, seed: int) -> bytes:
+    """Generate a PDF with titles, paragraphs, bullet lists, links and images."""
+    import fitz  # PyMuPDF
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    try:
+        for page_num in range(1, pages + 1):
+            page = doc.new_page()
+            page.insert_text((72, 80), f"Section {page_num}", fontsize=22)
+            y = 110
+            for _ in range(3):
+                paragraph = " ".join(rng.choices(LOREM, k=rng.randint(40, 80)))
+                page.insert_textbox(fitz.Rect(72, y, 540, y + 90), paragraph, fontsize=10)
+                y += 100
+            bullets = "\n".join(f"• {' '.join(rng.choices(LOREM, k=5))}" for _ in range(3))
+            page.insert_textbox(fitz.Rect(72, y, 540, y + 50), bullets, fontsize=10)
+            link_rect = fitz.Rect(72, y + 60, 300, y + 75)
+            page.insert_text((72, y + 72), "https://www.example.org/documentation", fontsize=10)
+            page.insert_link({'kind': fitz.LINK_URI, 'from': link_rect, 'uri': 'https://www.example.org/documentation'})
+            y += 90
+            for _ in range(images_per_page):
+                page.insert_image(fitz.Rect(72, y, 312, y + 120), stream=generate_image(rng))
+                y += 130
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+def build_documents(seed: int) -> Dict[str, bytes]:
+    return {
+        name: generate_pdf(profile['pages'], profile['images_per_page'], seed)
+        for name, profile in PDF_PROFILES.items()
+    }
+
+
+# --- Server lifecycle ------------------------------------------------------
+
+def serve(port: int, stub_ocr: bool, stub_ocr_delay: float) -> None:
+    """Run the server in this process, optionally with Tesseract stubbed out."""
+    import uvicorn
+    import server_enhanced
+
+    if stub_ocr:
+        def image_to_string(image, lang=None, **kwargs):
+            time.sleep(stub_ocr_delay)
+            return "Texte OCR simulé"
+
+        server_enhanced.pytesseract.image_to_string = image_to_string
+
+    uvicorn.run(server_enhanced.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    """Start the server in a subprocess and wait until /health answers."""
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port)]
+    if args.stub_ocr:
+        command += ['--stub-ocr', '--stub-ocr-delay', str(args.stub_ocr_delay)]
+    log = open(args.server_log, 'ab') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=log, stderr=log)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            with HTTP_OPENER.open(f"http://127.0.0.1:{port}/health", timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"Server did not become healthy within {SERVER_START_TIMEOUT}s")
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def read_rss(pid: int) -> Optional[Tuple[int, Optional[int]]]:
+    """Return (current RSS, peak RSS if known) of a process, in bytes.
+
+    The kernel-tracked peak (VmHWM on Linux, peak_wset on Windows) catches
+    short allocation spikes that polling the current RSS would miss.
+    """
+    # Linux: /proc reports the high-water mark directly
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+        rss = int(fields['VmRSS'].split()[0]) * 1024
+        peak = int(fields['VmHWM'].split()[0]) * 1024 if 'VmHWM' in fields else None
+        return rss, peak
+    except (OSError, KeyError, ValueError):
+        pass
+
+    # Other platforms fall back to psutil when it is installed
+    try:
+        import psutil
+        memory = psutil.Process(pid).memory_info()
+        return memory.rss, getattr(memory, 'peak_wset', None)
+    except Exception:
+        return None
+
+
+class RssMonitor:
+    """Poll a process' memory usage in the background and keep the peak."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-monitor", daemon=True)
+
+    def _run(self) -> None:
+        while True:
+            reading = read_rss(self.pid)
+            if reading is not None:
+                self.peak = max(value for value in (self.peak, *reading) if value is not None)
+            if self._stop.wait(RSS_POLL_INTERVAL):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+# --- Load generation -------------------------------------------------------
+
+def send_request(base_url: str, kind: str, documents: Dict[str, bytes], timeout: float) -> Tuple[int, Optional[str]]:
+    """Send one request of the given kind.
+
+    Returns the HTTP status and, on network errors, status 0 with a
+    description of the error.
+    """
+    if kind == 'health':
+        request = urllib.request.Request(f"{base_url}/health")
+    else:
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="{kind}.pdf"\r\n'
+            'Content-Type: application/pdf\r\n\r\n'
+        ).encode() + documents[kind] + f'\r\n--{boundary}--\r\n'.encode()
+        request = urllib.request.Request(
+            f"{base_url}/convert",
+            data=body,
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+            method='POST',
+        )
+    try:
+        with HTTP_OPENER.open(request, timeout=timeout) as response:
+            response.read()
+            return response.status, None
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except OSError as e:
+        reason = getattr(e, 'reason', None) or e
+        return 0, f"{type(reason).__name__}: {reason}"
+
+
+def run_load(base_url: str, documents: Dict[str, bytes], args: argparse.Namespace) -> Tuple[List[Dict[str, Any]], float]:
+    """Replay the request mix and return the per-request results and wall time.
+
+    With --rate, requests are sent open-loop on a Poisson schedule and latency
+    is measured from the scheduled send time, so client-side queueing counts.
+    Otherwise --concurrency workers send requests back to back.
+    """
+    weights = parse_mix(args.mix)
+    kinds, kind_weights = list(weights), list(weights.values())
+    rng = random.Random(args.seed)
+    results: List[Dict[str, Any]] = []
+    results_lock = threading.Lock()
+    schedule_lock = threading.Lock()
+    started = time.perf_counter()
+    end_time = started + args.duration if args.duration else None
+    sent = 0
+
+    def next_kind() -> Optional[str]:
+        nonlocal sent
+        with schedule_lock:
+            if end_time is not None and time.perf_counter() >= end_time:
+                return None
+            if end_time is None and sent >= args.requests:
+                return None
+            sent += 1
+            return rng.choices(kinds, kind_weights)[0]
+
+    def execute(kind: str, scheduled: float) -> None:
+        status, error = send_request(base_url, kind, documents, args.timeout)
+        latency = time.perf_counter() - scheduled
+        with results_lock:
+            if error is not None and not any(r['error'] for r in results):
+                print(f"First network error ({kind}): {error}")
+            results.append({'kind': kind, 'status': status, 'latency': latency, 'error': error})
+
+    def closed_loop_worker() -> None:
+        while True:
+            kind = next_kind()
+            if kind is None:
+                return
+            execute(kind, time.perf_counter())
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        if args.rate:
+            scheduled = started
+            while True:
+                kind = next_kind()
+                if kind is None:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(execute, kind, scheduled)
+                scheduled += rng.expovariate(args.rate)
+        else:
+            for _ in range(args.concurrency):
+                executor.submit(closed_loop_worker)
+
+    return results, time.perf_counter() - started
+
+
+# --- Reporting -------------------------------------------------------------
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(r['latency'] for r in results)
+    errors = sum(1 for r in results if not 200 <= r['status'] < 300)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'throughput': len(results) / elapsed if elapsed > 0 else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def build_report(results: List[Dict[str, Any]], elapsed: float, peak_rss: Optional[int], args: argparse.Namespace) -> Dict[str, Any]:
+    by_kind = {}
+    for kind in sorted({r['kind'] for r in results}):
+        by_kind[kind] = summarize([r for r in results if r['kind'] == kind], elapsed)
+    network_errors: Dict[str, int] = {}
+    for r in results:
+        if r['error'] is not None:
+            error_type = r['error'].split(':', 1)[0]
+            network_errors[error_type] = network_errors.get(error_type, 0) + 1
+    return {
+        'config': {
+            'target': 'external' if args.url else 'local',
+            'mix': args.mix,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'requests': args.requests,
+            'duration': args.duration,
+            'stub_ocr': args.stub_ocr,
+            'stub_ocr_delay': args.stub_ocr_delay if args.stub_ocr else None,
+            'seed': args.seed,
+        },
+        'elapsed': elapsed,
+        'overall': summarize(results, elapsed),
+        'by_kind': by_kind,
+        'network_errors': network_errors,
+        'peak_rss': peak_rss,
+    }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "n/a"
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    rows = [('overall', report['overall'])] + list(report['by_kind'].items())
+    print(f"\nCompleted in {report['elapsed']:.1f}s")
+    print(f"{'kind':<10}{'reqs':>7}{'err%':>8}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, stats in rows:
+        print(
+            f"{name:<10}{stats['requests']:>7}{stats['error_rate'] * 100:>7.1f}%{stats['throughput']:>9.2f}"
+            f"{format_seconds(stats['p50']):>10}{format_seconds(stats['p95']):>10}"
+            f"{format_seconds(stats['p99']):>10}{format_seconds(stats['max']):>10}"
+        )
+    for error_type, count in report['network_errors'].items():
+        print(f"Network errors ({error_type}): {count}")
+    peak_rss = report['peak_rss']
+    print(f"Peak server RSS: {peak_rss / (1024 * 1024):.1f}MB" if peak_rss else "Peak server RSS: n/a")
+
+
+def config_mismatches(report: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Return the workload settings that differ between a run and its baseline."""
+    current, previous = report['config'], baseline.get('config', {})
+    return [
+        f"{key}: baseline {previous.get(key)!r}, current {value!r}"
+        for key, value in current.items()
+        if previous.get(key) != value
+    ]
+
+
+def compare_to_baseline(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, error_tolerance: float) -> List[str]:
+    """Return a description of every metric that regressed past the baseline."""
+    regressions = []
+    current, previous = report['overall'], baseline['overall']
+
+    for metric in ('p50', 'p95', 'p99'):
+        if current[metric] is not None and previous.get(metric) is not None:
+            limit = previous[metric] * (1 + tolerance)
+            if current[metric] > limit:
+                regressions.append(
+                    f"{metric} latency {format_seconds(current[metric])} > {format_seconds(limit)} "
+                    f"(baseline {format_seconds(previous[metric])})"
+                )
+
+    if previous.get('throughput'):
+        limit = previous['throughput'] * (1 - tolerance)
+        if current['throughput'] < limit:
+            regressions.append(
+                f"throughput {current['throughput']:.2f} req/s < {limit:.2f} req/s "
+                f"(baseline {previous['throughput']:.2f} req/s)"
+            )
+
+    limit = previous.get('error_rate', 0.0) + error_tolerance
+    if current['error_rate'] > limit:
+        regressions.append(f"error rate {current['error_rate']:.1%} > {limit:.1%}")
+
+    if report['peak_rss'] and baseline.get('peak_rss'):
+        limit = baseline['peak_rss'] * (1 + tolerance)
+        if report['peak_rss'] > limit:
+            regressions.append(
+                f"peak RSS {report['peak_rss'] / (1024 * 1024):.1f}MB > {limit / (1024 * 1024):.1f}MB"
+            )
+
+    return regressions
+
+
+# --- Entry point -----------------------------------------------------------
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load-test the PDF to HTML conversion server locally")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"Weighted request mix, kinds: {', '.join(PDF_PROFILES)}, health (default: {DEFAULT_MIX})")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="Concurrent clients, or maximum in-flight requests with --rate (default: 10)")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Target arrival rate in requests/second (open-loop); closed-loop when omitted")
+    parser.add_argument('--requests', type=int, default=100, help="Total requests to send (default: 100)")
+    parser.add_argument('--duration', type=float, default=None, help="Run for this many seconds instead of --requests")
+    parser.add_argument('--timeout', type=float, default=300, help="Per-request timeout in seconds (default: 300)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for document generation and request order")
+    parser.add_argument('--stub-ocr', action='store_true', help="Replace Tesseract with a stub in the server")
+    parser.add_argument('--stub-ocr-delay', type=float, default=0.05,
+                        help="Simulated OCR latency in seconds when stubbed (default: 0.05)")
+    parser.add_argument('--url', default=None, help="Target an already running server instead of starting one")
+    parser.add_argument('--server-log', default=None, help="Append server output to this file")
+    parser.add_argument('--json-out', default=None, help="Write the report as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="Fail if results regress past this stored report")
+    parser.add_argument('--save-baseline', default=None, help="Store this run's report as a baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed relative regression for latency, throughput and RSS (default: 0.2)")
+    parser.add_argument('--error-tolerance', type=float, default=0.01,
+                        help="Allowed absolute increase of the error rate (default: 0.01)")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.url and args.stub_ocr:
+        parser.error("--stub-ocr only applies to the server started by the harness, not to --url")
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.serve:
+        serve(args.port, args.stub_ocr, args.stub_ocr_delay)
+        return 0
+
+    print("Generating documents...")
+    documents = build_documents(args.seed)
+    for name, data in documents.items():
+        print(f"  {name}: {PDF_PROFILES[name]['pages']} page(s), {len(data) / 1024:.0f}KB")
+
+    if args.url:
+        results, elapsed = run_load(args.url.rstrip('/'), documents, args)
+        peak_rss = None
+    else:
+        port = find_free_port()
+        print(f"Starting server on port {port}{' (OCR stubbed)' if args.stub_ocr else ''}...")
+        process = start_server(port, args)
+        try:
+            with RssMonitor(process.pid) as monitor:
+                results, elapsed = run_load(f"http://127.0.0.1:{port}", documents, args)
+            peak_rss = monitor.peak
+        finally:
+            stop_server(process)
+
+    report = build_report(results, elapsed, peak_rss, args)
+    print_report(report)
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatches = config_mismatches(report, baseline)
+        if mismatches:
+            print("\nBaseline was recorded with a different workload, results are not comparable:")
+            for mismatch in mismatches:
+                print(f"  - {mismatch}")
+            return 2
+        regressions = compare_to_baseline(report, baseline, args.tolerance, args.error_tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print("\nNo regression against baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
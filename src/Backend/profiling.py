@@ -0,0 +1,225 @@
+"""On-demand profiling of a single conversion request.
+
+Spans are recorded with the ``span()`` context manager. When no profiler is
+active for the current context, ``span()`` returns a shared no-op context
+manager, so instrumented code costs nothing measurable in normal operation.
+"""
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Any, Tuple
+
+
+PROFILE_FORMATS = {'chrome', 'speedscope'}
+DEFAULT_SAMPLE_INTERVAL = 0.005  # 5ms
+
+_active_profiler: ContextVar[Optional["RequestProfiler"]] = ContextVar("active_profiler", default=None)
+
+
+class _NullSpan:
+    """No-op context manager returned when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Context manager recording one timed span into a profiler."""
+
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler: "RequestProfiler", name: str, args: Dict[str, Any]):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.profiler.record(self.name, self.start, end, threading.get_ident(), self.args)
+        return False
+
+
+def span(name: str, **args: Any):
+    """Time a block of code in the active profiler, if any."""
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return _NULL_SPAN
+    return _Span(profiler, name, args)
+
+
+class RequestProfiler:
+    """Collect spans and optional stack samples for one request.
+
+    Spans are exported as a Chrome trace (chrome://tracing, Perfetto) or as a
+    speedscope file, which also carries the sampled stacks when sampling is on.
+    """
+
+    def __init__(self, name: str, sample_interval: Optional[float] = None):
+        self.name = name
+        self.sample_interval = sample_interval
+        self.origin = time.perf_counter()
+        self.spans: List[Tuple[str, float, float, int, Dict[str, Any]]] = []
+        self.samples: List[Tuple[float, Tuple[Tuple[str, str, int], ...]]] = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, end: float, thread_id: int, args: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append((name, start, end, thread_id, args))
+
+    @contextmanager
+    def activate(self):
+        """Make this profiler the target of ``span()`` in the current context."""
+        token = _active_profiler.set(self)
+        try:
+            yield self
+        finally:
+            _active_profiler.reset(token)
+
+    @contextmanager
+    def sampling(self):
+        """Sample the calling thread's stack until the block exits."""
+        if not self.sample_interval:
+            yield self
+            return
+
+        target = threading.get_ident()
+        stop = threading.Event()
+
+        def sample_loop():
+            while not stop.wait(self.sample_interval):
+                frame = sys._current_frames().get(target)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples.append((time.perf_counter(), tuple(stack)))
+
+        sampler = threading.Thread(target=sample_loop, name="profile-sampler", daemon=True)
+        sampler.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            sampler.join()
+
+    def _micros(self, timestamp: float) -> float:
+        return round((timestamp - self.origin) * 1_000_000, 3)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Export spans in the Chrome trace event format."""
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": self._micros(start),
+                "dur": round((end - start) * 1_000_000, 3),
+                "pid": pid,
+                "tid": thread_id,
+                "args": args,
+            }
+            for name, start, end, thread_id, args in self.spans
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": self.name},
+        }
+
+    def to_speedscope(self) -> Dict[str, Any]:
+        """Export spans (one evented profile per thread) and samples in speedscope format."""
+        frames: List[Dict[str, Any]] = []
+        frame_index: Dict[Any, int] = {}
+
+        def frame_id(key, frame):
+            if key not in frame_index:
+                frame_index[key] = len(frames)
+                frames.append(frame)
+            return frame_index[key]
+
+        end_value = max((self._micros(end) for _, _, end, _, _ in self.spans), default=0)
+        profiles = []
+
+        spans_by_thread: Dict[int, list] = {}
+        for name, start, end, thread_id, _ in self.spans:
+            spans_by_thread.setdefault(thread_id, []).append((start, end, name))
+
+        for thread_id, thread_spans in spans_by_thread.items():
+            # Spans of one thread are properly nested: replay them with a stack
+            thread_spans.sort(key=lambda s: (s[0], -s[1]))
+            events = []
+            open_spans: List[Tuple[float, int]] = []
+            for start, end, name in thread_spans:
+                while open_spans and open_spans[-1][0] <= start:
+                    closed_end, closed_index = open_spans.pop()
+                    events.append({"type": "C", "at": self._micros(closed_end), "frame": closed_index})
+                index = frame_id(("span", name), {"name": name})
+                events.append({"type": "O", "at": self._micros(start), "frame": index})
+                open_spans.append((end, index))
+            while open_spans:
+                closed_end, closed_index = open_spans.pop()
+                events.append({"type": "C", "at": self._micros(closed_end), "frame": closed_index})
+            profiles.append({
+                "type": "evented",
+                "name": f"Spans (thread {thread_id})",
+                "unit": "microseconds",
+                "startValue": 0,
+                "endValue": end_value,
+                "events": events,
+            })
+
+        if self.samples:
+            samples = []
+            weights = []
+            previous = self.origin
+            for timestamp, stack in self.samples:
+                samples.append([
+                    frame_id(("code", name, filename, line), {"name": name, "file": filename, "line": line})
+                    for name, filename, line in stack
+                ])
+                weights.append(round((timestamp - previous) * 1_000_000, 3))
+                previous = timestamp
+            profiles.append({
+                "type": "sampled",
+                "name": "Sampled stacks",
+                "unit": "microseconds",
+                "startValue": 0,
+                "endValue": self._micros(previous),
+                "samples": samples,
+                "weights": weights,
+            })
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "pdf-accessible-html",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    def export(self, fmt: str) -> Dict[str, Any]:
+        if fmt == 'speedscope':
+            return self.to_speedscope()
+        return self.to_chrome_trace()
@@ -1,5 +1,6 @@
-from fastapi import FastAPI, UploadFile, HTTPException, File
+from fastapi import FastAPI, UploadFile, HTTPException, File, Request, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import fitz  # PyMuPDF
 from PIL import Image
 import pytesseract
@@ -11,9 +12,13 @@ import os
 import logging
 import base64
 import platform
+import threading
+import time
 from typing import Optional, List, Dict, Any
 import asyncio
+import secrets
 
+from profiling import RequestProfiler, PROFILE_FORMATS, DEFAULT_SAMPLE_INTERVAL, span as trace_span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -86,6 +91,13 @@ app.add_middleware(
 # Configuration constants
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 ALLOWED_EXTENSIONS = {'.pdf'}
+# Wall-clock budget for a single conversion, in seconds (0 disables the limit)
+MAX_PROCESSING_SECONDS = float(os.getenv('MAX_PROCESSING_SECONDS', '120'))
+# How often the server checks whether the client is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+OCR_FALLBACK_TEXT = "Image sans texte détectable"
+# Shared secret enabling per-request profiling (profiling is disabled when unset)
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
 
 # Enhanced CSS for better accessibility and readability
 css = """
@@ -176,6 +188,64 @@ section {
 </style>
 """
 
+class ConversionCancelled(Exception):
+    """Raised when the client went away before the conversion finished."""
+
+
+class ConversionBudget:
+    """Track client cancellation and the wall-clock budget of a conversion.
+
+    The budget is shared between the request handler, which cancels it when
+    the client disconnects, and the worker thread running the conversion,
+    which checks it between pages, blocks and OCR calls.
+    """
+
+    def __init__(self, max_seconds: Optional[float] = None):
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + max_seconds if max_seconds else None
+        self._cancel_event = threading.Event()
+        self.skipped_pages = 0
+        self.skipped_ocr = 0
+        self.truncated_pages = 0
+
+    def cancel(self) -> None:
+        """Request the conversion to stop as soon as possible."""
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def partial(self) -> bool:
+        """Whether some work was skipped because the budget ran out."""
+        return self.skipped_pages > 0 or self.truncated_pages > 0 or self.skipped_ocr > 0
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise ConversionCancelled()
+
+    def warnings(self) -> List[str]:
+        """Describe the work skipped because of the time budget."""
+        warnings = []
+        if self.skipped_pages:
+            warnings.append(
+                f"Délai de traitement dépassé : {self.skipped_pages} page(s) non traitée(s)"
+            )
+        if self.truncated_pages:
+            warnings.append(
+                f"Délai de traitement dépassé : {self.truncated_pages} page(s) traitée(s) partiellement"
+            )
+        if self.skipped_ocr:
+            warnings.append(
+                f"Délai de traitement dépassé : OCR ignoré pour {self.skipped_ocr} image(s)"
+            )
+        return warnings
+
 def validate_file(file: UploadFile) -> None:
     """Validate uploaded file."""
     if not file.filename:
@@ -189,14 +259,22 @@ def validate_file(file: UploadFile) -> None:
             detail=f"Invalid file type. Only {', '.join(ALLOWED_EXTENSIONS)} files are allowed"
         )
 
-def safe_ocr_extract(image: Image.Image, lang: str = "eng") -> str:
-    """Safely extract text from image using OCR."""
+def safe_ocr_extract(image: Image.Image, lang: str = "eng", budget: Optional[ConversionBudget] = None) -> str:
+    """Safely extract text from image using OCR.
+
+    OCR is skipped when the conversion budget is cancelled or exhausted.
+    """
+    if budget is not None and (budget.cancelled or budget.expired):
+        if not budget.cancelled:
+            budget.skipped_ocr += 1
+        return OCR_FALLBACK_TEXT
     try:
-        text = pytesseract.image_to_string(image, lang=lang).strip()
-        return text if text else "Image sans texte détectable"
+        with trace_span("safe_ocr_extract", lang=lang, size=f"{image.width}x{image.height}"):
+            text = pytesseract.image_to_string(image, lang=lang).strip()
+        return text if text else OCR_FALLBACK_TEXT
     except Exception as e:
         logger.warning(f"OCR extraction failed: {e}")
-        return "Image sans texte détectable"
+        return OCR_FALLBACK_TEXT
 
 def calculate_accessibility_score(html_content: str) -> tuple[int, List[str]]:
     """Calculate accessibility score and return warnings."""
@@ -245,8 +323,12 @@ def calculate_accessibility_score(html_content: str) -> tuple[int, List[str]]:
     
     return max(0, score), warnings
 
-def is_big_title(block: Dict[str, Any], doc) -> bool:
-    """Detection of big titles based on font size."""
+def is_big_title(block: Dict[str, Any], doc, budget: Optional[ConversionBudget] = None) -> bool:
+    """Detection of big titles based on font size.
+
+    The scan of the document stops as soon as the budget is cancelled or
+    exhausted; the block is then treated as regular text.
+    """
     if block['type'] != 0 or len(block['lines']) == 0:
         return False
     
@@ -260,6 +342,10 @@ def is_big_title(block: Dict[str, Any], doc) -> bool:
         
         all_font_sizes = []
         for p in doc:
+            if budget is not None:
+                budget.raise_if_cancelled()
+                if budget.expired:
+                    return False
             for b in p.get_text("dict")["blocks"]:
                 if b['type'] == 0:
                     for l in b['lines']:
@@ -277,32 +363,33 @@ def is_big_title(block: Dict[str, Any], doc) -> bool:
         logger.warning(f"Error in title detection: {e}")
         return False
 
-def process_text_block(block: Dict[str, Any], html_output: List[str], find_link_for_span, doc) -> None:
+def process_text_block(block: Dict[str, Any], html_output: List[str], find_link_for_span, doc, budget: Optional[ConversionBudget] = None) -> None:
     """Process a text block and add it to HTML output."""
     content = []
     
-    for line in block["lines"]:
-        for span in line["spans"]:
-            text = span.get("text", "").strip()
-            if not text:
-                continue
+    with trace_span("link_matching"):
+        for line in block["lines"]:
+            for span in line["spans"]:
+                text = span.get("text", "").strip()
+                if not text:
+                    continue
+                    
+                # Clean up bullet point characters
+                text = text.replace('\u2022', '•').replace('\uf0b7', '•')
                 
-            # Clean up bullet point characters
-            text = text.replace('\u2022', '•').replace('\uf0b7', '•')
-            
-            # Check for links
-            link = find_link_for_span(span.get("bbox", [0, 0, 0, 0]))
-            if link:
-                text = f'<a href="{link}" target="_blank" rel="noopener noreferrer">{text}</a>'
-            else:
-                # Check for URLs in text and make them clickable
-                url_pattern = r'(https?://[^\s]+|www\.[^\s]+)'
-                url_matches = re.findall(url_pattern, text)
-                for url_match in url_matches:
-                    full_url = url_match if url_match.startswith('http') else f'http://{url_match}'
-                    text = text.replace(url_match, f'<a href="{full_url}" target="_blank" rel="noopener noreferrer">{url_match}</a>')
-            
-            content.append(text)
+                # Check for links
+                link = find_link_for_span(span.get("bbox", [0, 0, 0, 0]))
+                if link:
+                    text = f'<a href="{link}" target="_blank" rel="noopener noreferrer">{text}</a>'
+                else:
+                    # Check for URLs in text and make them clickable
+                    url_pattern = r'(https?://[^\s]+|www\.[^\s]+)'
+                    url_matches = re.findall(url_pattern, text)
+                    for url_match in url_matches:
+                        full_url = url_match if url_match.startswith('http') else f'http://{url_match}'
+                        text = text.replace(url_match, f'<a href="{full_url}" target="_blank" rel="noopener noreferrer">{url_match}</a>')
+                
+                content.append(text)
     
     content_text = " ".join(content).strip()
     if not content_text:
@@ -320,10 +407,11 @@ def process_text_block(block: Dict[str, Any], html_output: List[str], find_link_
             return
     
     # Determine if this is a title or regular text
-    tag = "h3" if is_big_title(block, doc) else "p"
+    with trace_span("title_detection"):
+        tag = "h3" if is_big_title(block, doc, budget) else "p"
     html_output.append(f'<{tag}>{content_text}</{tag}>')
 
-def process_image_block(block: Dict[str, Any], html_output: List[str]) -> None:
+def process_image_block(block: Dict[str, Any], html_output: List[str], budget: Optional[ConversionBudget] = None) -> None:
     """Process an image block and add it to HTML output."""
     try:
         raw = block.get("image")
@@ -333,14 +421,15 @@ def process_image_block(block: Dict[str, Any], html_output: List[str]) -> None:
         pil_img = Image.open(BytesIO(raw))
         
         # Convert image to base64
-        buffer = BytesIO()
-        img_format = pil_img.format if pil_img.format else 'PNG'
-        pil_img.save(buffer, format=img_format)
-        img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        mime_type = f"image/{img_format.lower()}"
+        with trace_span("encode_image", bytes=len(raw)):
+            buffer = BytesIO()
+            img_format = pil_img.format if pil_img.format else 'PNG'
+            pil_img.save(buffer, format=img_format)
+            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            mime_type = f"image/{img_format.lower()}"
         
         # Extract alt text using OCR
-        alt_text = safe_ocr_extract(pil_img, lang="fra")
+        alt_text = safe_ocr_extract(pil_img, lang="fra", budget=budget)
         
         # Add image to HTML
         html_output.append(
@@ -354,11 +443,19 @@ def process_image_block(block: Dict[str, Any], html_output: List[str]) -> None:
         logger.warning(f"Error processing image: {e}")
         html_output.append('<p><em>[Image non disponible]</em></p>')
 
-def pdf_to_accessible_html(pdf_path: str) -> tuple[str, str]:
-    """Convert PDF to accessible HTML with enhanced error handling."""
+def pdf_to_accessible_html(pdf_path: str, budget: Optional[ConversionBudget] = None) -> tuple[str, str]:
+    """Convert PDF to accessible HTML with enhanced error handling.
+
+    When a budget is given, the conversion stops with ConversionCancelled once
+    it is cancelled, and pages left when its deadline passes are marked as
+    unprocessed instead of being converted.
+    """
+    if budget is None:
+        budget = ConversionBudget()
     doc = None
     try:
-        doc = fitz.open(pdf_path)
+        with trace_span("open_document"):
+            doc = fitz.open(pdf_path)
         
         # Get document metadata
         title = doc.metadata.get('title', '').strip()
@@ -387,59 +484,90 @@ def pdf_to_accessible_html(pdf_path: str) -> tuple[str, str]:
         logger.info(f"Processing PDF with {total_pages} pages")
 
         for page_num, page in enumerate(doc, start=1):
-            logger.info(f"Processing page {page_num}/{total_pages}")
+            budget.raise_if_cancelled()
             
             if page_num > 1:
                 html_output.append(f'<div class="page-break" aria-label="Nouvelle page"></div>')
             
             html_output.append(f'<section aria-label="Page {page_num} sur {total_pages}">')
             html_output.append(f'<h2>Page {page_num}</h2>')
+
+            if budget.expired:
+                budget.skipped_pages += 1
+                html_output.append('<p><em>Page non traitée : délai de traitement dépassé</em></p>')
+                html_output.append('</section>')
+                continue
+
+            logger.info(f"Processing page {page_num}/{total_pages}")
             
-            try:
-                # Get page blocks and sort them by position
-                blocks = sorted(
-                    page.get_text("dict")["blocks"],
-                    key=lambda b: (b.get("bbox", [0, 0, 0, 0])[1], b.get("bbox", [0, 0, 0, 0])[0])
-                )
-
-                # Extract links
-                links = page.get_links()
-                links_zones = []
-                for link in links:
-                    if link.get('kind') == 2 and 'uri' in link:
-                        links_zones.append((link['from'], link['uri']))
-
-                def find_link_for_span(span_bbox):
-                    """Find link URL for a given span based on its bounding box."""
-                    for bbox, uri in links_zones:
-                        x0, y0, x1, y1 = bbox
-                        sx0, sy0, sx1, sy1 = span_bbox
-                        cx, cy = (sx0 + sx1) / 2, (sy0 + sy1) / 2
-                        if x0 <= cx <= x1 and y0 <= cy <= y1:
-                            return uri
-                    return None
-
-                # Process each block
-                for block in blocks:
-                    try:
-                        if block["type"] == 0:  # Text block
-                            process_text_block(block, html_output, find_link_for_span, doc)
-                        elif block["type"] == 1:  # Image block
-                            process_image_block(block, html_output)
-                    except Exception as e:
-                        logger.warning(f"Error processing block on page {page_num}: {e}")
-                        continue
-
-            except Exception as e:
-                logger.error(f"Error processing page {page_num}: {e}")
-                html_output.append(f'<p><em>Erreur lors du traitement de la page {page_num}</em></p>')
+            with trace_span("page", page=page_num):
+                try:
+                    # Get page blocks and sort them by position
+                    with trace_span("extract_blocks"):
+                        blocks = sorted(
+                            page.get_text("dict")["blocks"],
+                            key=lambda b: (b.get("bbox", [0, 0, 0, 0])[1], b.get("bbox", [0, 0, 0, 0])[0])
+                        )
+
+                    # Extract links
+                    with trace_span("extract_links"):
+                        links = page.get_links()
+                    links_zones = []
+                    for link in links:
+                        if link.get('kind') == 2 and 'uri' in link:
+                            links_zones.append((link['from'], link['uri']))
+
+                    def find_link_for_span(span_bbox):
+                        """Find link URL for a given span based on its bounding box."""
+                        for bbox, uri in links_zones:
+                            x0, y0, x1, y1 = bbox
+                            sx0, sy0, sx1, sy1 = span_bbox
+                            cx, cy = (sx0 + sx1) / 2, (sy0 + sy1) / 2
+                            if x0 <= cx <= x1 and y0 <= cy <= y1:
+                                return uri
+                        return None
+
+                    # Process each block
+                    for block in blocks:
+                        budget.raise_if_cancelled()
+                        if budget.expired:
+                            budget.truncated_pages += 1
+                            html_output.append('<p><em>Suite de la page non traitée : délai de traitement dépassé</em></p>')
+                            break
+                        try:
+                            if block["type"] == 0:  # Text block
+                                with trace_span("process_text_block"):
+                                    process_text_block(block, html_output, find_link_for_span, doc, budget)
+                            elif block["type"] == 1:  # Image block
+                                with trace_span("process_image_block"):
+                                    process_image_block(block, html_output, budget)
+                        except ConversionCancelled:
+                            raise
+                        except Exception as e:
+                            logger.warning(f"Error processing block on page {page_num}: {e}")
+                            continue
+
+                except ConversionCancelled:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error processing page {page_num}: {e}")
+                    html_output.append(f'<p><em>Erreur lors du traitement de la page {page_num}</em></p>')
 
             html_output.append('</section>')
 
         html_output.extend(['</main>', '</body>', '</html>'])
         
+        if budget.partial:
+            logger.warning(
+                f"Time budget exhausted: {budget.skipped_pages} page(s) skipped, "
+                f"{budget.truncated_pages} page(s) truncated and "
+                f"{budget.skipped_ocr} OCR call(s) skipped"
+            )
+
         return "\n".join(html_output), title
 
+    except ConversionCancelled:
+        raise
     except Exception as e:
         logger.error(f"Error converting PDF: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur lors de la conversion du PDF: {str(e)}")
@@ -447,13 +575,56 @@ def pdf_to_accessible_html(pdf_path: str) -> tuple[str, str]:
         if doc:
             doc.close()
 
+def convert_and_score(pdf_path: str, budget: ConversionBudget) -> tuple[str, str, int, List[str]]:
+    """Convert a PDF and compute its accessibility score."""
+    with trace_span("pdf_to_accessible_html"):
+        html_content, title = pdf_to_accessible_html(pdf_path, budget)
+    with trace_span("calculate_accessibility_score"):
+        score, warnings = calculate_accessibility_score(html_content)
+    return html_content, title, score, warnings
+
+def profiled_convert_and_score(pdf_path: str, budget: ConversionBudget, profiler: RequestProfiler):
+    """Run convert_and_score with the profiler active in the worker thread."""
+    with profiler.activate(), profiler.sampling():
+        return convert_and_score(pdf_path, budget)
+
+def check_profiling_access(profile: str, token: Optional[str]) -> None:
+    """Ensure a profiling request is well-formed and authorized."""
+    # Compare bytes: compare_digest rejects non-ASCII str, and headers are decoded as latin-1
+    if not PROFILING_TOKEN or not token or not secrets.compare_digest(
+        token.encode('utf-8'), PROFILING_TOKEN.encode('utf-8')
+    ):
+        raise HTTPException(status_code=403, detail="Profiling is not allowed")
+    if profile not in PROFILE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid profile format. Allowed formats: {', '.join(sorted(PROFILE_FORMATS))}"
+        )
+
+async def cancel_on_disconnect(request: Request, budget: ConversionBudget) -> None:
+    """Cancel the conversion budget as soon as the client disconnects."""
+    while not budget.cancelled:
+        if await request.is_disconnected():
+            logger.info("Client disconnected, cancelling conversion")
+            budget.cancel()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
 @app.post("/convert")
-async def convert_pdf(file: UploadFile = File(...)):
+async def convert_pdf(
+    request: Request,
+    file: UploadFile = File(...),
+    profile: Optional[str] = Query(None, description="Return a trace of the conversion ('chrome' or 'speedscope')"),
+    sample: bool = Query(False, description="Also sample stacks (speedscope format only)"),
+    x_profile_token: Optional[str] = Header(None),
+):
     """Convert uploaded PDF to accessible HTML."""
     logger.info(f"Received file: {file.filename}")
     
     # Validate file
     validate_file(file)
+    if profile is not None:
+        check_profiling_access(profile, x_profile_token)
     
     # Check file size
     contents = await file.read()
@@ -468,28 +639,52 @@ async def convert_pdf(file: UploadFile = File(...)):
         tmp.write(contents)
         tmp_path = tmp.name
     
+    budget = ConversionBudget(MAX_PROCESSING_SECONDS)
+    watcher = asyncio.create_task(cancel_on_disconnect(request, budget))
+    
+    profiler = None
+    if profile is not None:
+        sample_interval = DEFAULT_SAMPLE_INTERVAL if sample and profile == 'speedscope' else None
+        profiler = RequestProfiler(file.filename, sample_interval=sample_interval)
+    
     try:
-        # Convert PDF to HTML
-        html_content, title = pdf_to_accessible_html(tmp_path)
-        
-        # Calculate accessibility score
-        score, warnings = calculate_accessibility_score(html_content)
+        # Convert PDF to HTML in a worker thread so disconnects can be detected
+        if profiler is None:
+            html_content, title, score, warnings = await run_in_threadpool(convert_and_score, tmp_path, budget)
+        else:
+            html_content, title, score, warnings = await run_in_threadpool(
+                profiled_convert_and_score, tmp_path, budget, profiler
+            )
+        warnings = budget.warnings() + warnings
         
         logger.info(f"Conversion completed for {file.filename}. Score: {score}")
         
-        return {
+        result = {
             "html": html_content,
             "title": title,
             "accessibilityScore": score,
-            "warnings": warnings
+            "warnings": warnings,
+            "partial": budget.partial
         }
+        if profiler is not None:
+            stem = os.path.splitext(os.path.basename(file.filename))[0]
+            result["profile"] = {
+                "format": profile,
+                "filename": f"{stem}.{profile}.json",
+                "trace": profiler.export(profile)
+            }
+        return result
         
+    except ConversionCancelled:
+        logger.info(f"Conversion of {file.filename} cancelled after client disconnect")
+        raise HTTPException(status_code=499, detail="Client disconnected")
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Unexpected error converting {file.filename}: {e}")
         raise HTTPException(status_code=500, detail="Erreur interne du serveur")
     finally:
+        watcher.cancel()
         # Clean up temporary file
         try:
             os.unlink(tmp_path)
@@ -5,4 +5,5 @@ export interface ConversionResult {
   title?: string;
   accessibilityScore?: number;
   warnings?: string[];
+  partial?: boolean;
 }
\ No newline at end of file